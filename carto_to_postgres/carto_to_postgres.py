@@ -1,45 +1,188 @@
 import json
 import os
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from functools import lru_cache
+from itertools import repeat
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows
+    fcntl = None
 
-import geopandas as gpd
-import pandas as pd
 import psycopg2
+from psycopg2 import sql
+from psycopg2.pool import ThreadedConnectionPool
 from tqdm import tqdm
 from carto.auth import APIKeyAuthClient
-from carto.sql import CopySQLClient
-from cartoframes.utils import decode_geometry
-from shapely.geometry.base import BaseGeometry
-from sqlalchemy import create_engine
+from carto.sql import CopySQLClient, SQLClient
 
 COLLISION_STRATEGIES = ['fail', 'replace']
 
+# PostgreSQL NAMEDATALEN - 1
+PG_MAX_IDENTIFIER_LENGTH = 63
+
+CHUNK_SIZE = 64 * 1024
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+# Upper bounds, the actual values are derived from the connection budget of the run
+COPY_PARTS = min(os.cpu_count() or 1, 8)
+
+# Smaller parts cost more in requests and connections than they gain in parallelism
+MIN_PART_ROWS = 100000
+
+TABLE_WORKERS = 8
+
+MAX_CONNECTIONS = 16
+
+# Session settings for the bulk load, they only require regular user privileges
+SESSION_SETTINGS = {
+    "synchronous_commit": "off"
+}
+
+# Used by each spatial index build, up to TABLE_WORKERS of them can run at once
+MAINTENANCE_WORK_MEM = '256MB'
 
-def download_carto_dataset(username, api_key, table_name):
+
+def carto_copy_client(username, api_key):
     """
-    Function to download a CARTO dataset as a CSV file using COPY to command through CARTO's SQL API
+    Function to create a client for CARTO's SQL API COPY endpoints
 
-    Returns name of the downloaded file (file_name, str)
+    Returns CARTO COPY client (copy_client, CopySQLClient)
     args:
         username: CARTO account username (str)
         api_key: CARTO API key with access to the dataset (str)
+    """
+
+    base_url = f"https://{username}.carto.com"
+
+    return CopySQLClient(APIKeyAuthClient(base_url, api_key))
+
+
+def quote_literal(value):
+    """
+    Function to quote a string as a SQL literal, for queries sent through CARTO's SQL API
+
+    Returns quoted literal (literal, str)
+    args:
+        value: string to quote (str)
+    """
+
+    return "'" + value.replace("'", "''") + "'"
+
+
+def carto_dataset_columns(copy_client, table_name):
+    """
+    Function to get the column names and data types of a CARTO dataset from its catalog
+    through CARTO's SQL API
+
+    The dataset name is resolved by CARTO itself, which returns it quoted where needed,
+    so it can be safely used in later queries
+
+    Returns quoted dataset name (source, str) and column names and SQL data types
+    in table order (columns, list of (str, str))
+    args:
+        copy_client: CARTO COPY client (CopySQLClient)
         table_name: Target CARTO dataset
     """
 
-    file_name = f"{table_name}.csv"
+    sql_client = SQLClient(copy_client.client)
 
-    print(f"Downloading dataset {table_name}")
+    rows = sql_client.send(f"""
+        SELECT attrelid::regclass::text AS source, attname AS name, format_type(atttypid, atttypmod) AS type
+        FROM pg_attribute
+        WHERE attrelid = {quote_literal(table_name)}::regclass AND attnum > 0 AND NOT attisdropped
+        ORDER BY attnum
+        """)['rows']
 
-    base_url = f"https://{username}.carto.com"
+    return rows[0]['source'], [(row['name'], row['type']) for row in rows]
+
+
+def carto_dataset_ranges(copy_client, table_name, parts=COPY_PARTS):
+    """
+    Function to split a CARTO dataset into cartodb_id ranges, so it can be copied in parallel
 
-    copy_client = CopySQLClient(APIKeyAuthClient(base_url, api_key))
+    The number of ranges is limited by the table size estimated by CARTO's planner,
+    so that each one holds at least MIN_PART_ROWS rows
 
-    to_query = f"COPY {table_name} TO stdout WITH (FORMAT csv, HEADER true)"
+    Returns SQL conditions that together cover the whole dataset (ranges, list of str)
+    args:
+        copy_client: CARTO COPY client (CopySQLClient)
+        table_name: Target CARTO dataset, as quoted by carto_dataset_columns (str)
+        parts: maximum number of ranges (int), default min(cpu_count, 8)
+    """
+
+    sql_client = SQLClient(copy_client.client)
+
+    bounds = sql_client.send(f"""
+        SELECT min(cartodb_id), max(cartodb_id),
+               (SELECT reltuples FROM pg_class WHERE oid = {quote_literal(table_name)}::regclass) AS rows
+        FROM {table_name}
+        """)['rows'][0]
+
+    # reltuples is -1 for tables that were never analyzed
+    parts = min(parts, int(bounds['rows']) // MIN_PART_ROWS)
+
+    if bounds['min'] is None or parts <= 1:
+        return ['true']
+
+    step = (bounds['max'] - bounds['min']) // parts + 1
+
+    return [f"cartodb_id >= {lower} AND cartodb_id < {lower + step}"
+            for lower in range(bounds['min'], bounds['max'] + 1, step)]
+
+
+def download_carto_dataset(copy_client, table_name, where=None):
+    """
+    Function to stream a CARTO dataset in PostgreSQL binary format using COPY to command
+    through CARTO's SQL API
+
+    The response is written by a background thread into an OS pipe, so the data can be
+    read while it is being downloaded, without storing it on disk.
+    The read end must be closed by the caller, which also stops the download.
+
+    Returns read end of the pipe (stream, file object) and the download future (download, Future),
+    whose result raises any error that happened while downloading
+    args:
+        copy_client: CARTO COPY client (CopySQLClient)
+        table_name: Target CARTO dataset, as quoted by carto_dataset_columns (str)
+        where: SQL condition to download only part of the dataset (str), default None
+    """
+
+    source = f"(SELECT * FROM {table_name} WHERE {where})" if where else table_name
 
-    copy_client.copyto_file_path(to_query, f'{table_name}.csv')
+    to_query = f"COPY {source} TO stdout WITH (FORMAT binary)"
 
-    print(f"Dataset {table_name} downloaded")
+    response = copy_client.copyto(to_query)
 
-    return file_name
+    read_fd, write_fd = os.pipe()
+
+    # Linux pipes hold 64 KiB by default, let the download get a whole COPY block ahead
+    if hasattr(fcntl, 'F_SETPIPE_SZ'):
+        try:
+            fcntl.fcntl(write_fd, fcntl.F_SETPIPE_SZ, COPY_BUFFER_SIZE)
+        except OSError:
+            # Unprivileged users can exceed fs.pipe-user-pages-soft, keep the default size
+            pass
+
+    download = Future()
+
+    def write_pipe():
+        try:
+            with os.fdopen(write_fd, 'wb') as pipe:
+                for block in response.iter_content(CHUNK_SIZE):
+                    pipe.write(block)
+        except Exception as e:
+            download.set_exception(e)
+        else:
+            download.set_result(None)
+        finally:
+            response.close()
+
+    threading.Thread(target=write_pipe, daemon=True).start()
+
+    return os.fdopen(read_fd, 'rb', buffering=COPY_BUFFER_SIZE), download
 
 
 def connect_database(
@@ -51,35 +194,29 @@ def connect_database(
         sslmode=None,
         sslrootcert=None,
         sslcert=None,
-        sslkey=None):
+        sslkey=None,
+        maintenance_work_mem=None,
+        maxconn=TABLE_WORKERS * COPY_PARTS):
     """
     Function to connect to a PostgreSQL database
 
-    Returns SQLAlchemy and psycopg2 connection objects
+    Connections are opened on demand and kept open once returned to the pool, so they are
+    reused across tables instead of connecting again for each one.
+    Every connection starts its session with SESSION_SETTINGS, maintenance_work_mem and UTF8 client encoding
+
+    Returns psycopg2 thread safe connection pool (pool, ThreadedConnectionPool)
     args:
         host: database server corresponding host (str)
         database: database name (str)
         user: database target user (str)
         password: user's corresponding password (str)
+        maintenance_work_mem: memory for each spatial index build (str), default MAINTENANCE_WORK_MEM
+        maxconn: number of connections (int), default TABLE_WORKERS * COPY_PARTS
     """
 
-    args = {
-        "host": host,
-        "user": user,
-        "port": port or 5432,
-        "password": password,
-        "database": database,
-        "sslcert": sslcert or None,
-        "sslkey": sslkey or None,
-        "sslrootcert": sslrootcert or None,
-        "sslmode": sslmode or 'prefer'
-    }
-
-    engine = create_engine(
-        f"postgresql+psycopg2://{host}:{port}:{user}@{password}/{database}",
-        connect_args=args)
-
-    con = psycopg2.connect(
+    pool = ThreadedConnectionPool(
+        minconn=0,
+        maxconn=maxconn,
         host=host,
         database=database,
         user=user,
@@ -88,25 +225,30 @@ def connect_database(
         sslmode=sslmode,
         sslrootcert=sslrootcert,
         sslcert=sslcert,
-        sslkey=sslkey)
+        sslkey=sslkey,
+        client_encoding='UTF8',
+        options=' '.join(f"-c {name}={value}" for name, value in dict(
+            SESSION_SETTINGS, maintenance_work_mem=maintenance_work_mem or MAINTENANCE_WORK_MEM).items()))
 
-    return engine, con
+    # psycopg2 opens minconn connections upfront, and closes returned connections
+    # once the pool holds minconn of them
+    pool.minconn = maxconn
 
+    return pool
 
+
+@lru_cache(maxsize=1024)
 def check_table_name_length(table_name):
     """
-    Function to check if a table name length is below PostgreSQL 63 byte limit
+    Function to check if a table name length is within PostgreSQL 63 byte limit
 
-    Returns table name below this limit, truncating original name if necessary (table_name, str)
+    Returns table name within this limit, truncating original name if necessary (table_name, str)
     args:
-        host: database server corresponding host (str)
-        database: database name (str)
-        user: database target user (str)
-        password: user's corresponding password (str)
+        table_name: desired database table name (str)
     """
 
-    if len(table_name) >= 63:
-        table_name = table_name[:62]
+    if len(table_name.encode('utf-8')) > PG_MAX_IDENTIFIER_LENGTH:
+        table_name = table_name.encode('utf-8')[:PG_MAX_IDENTIFIER_LENGTH].decode('utf-8', 'ignore')
 
         print(f"Table name too large, truncating to {table_name}")
 
@@ -114,34 +256,30 @@ def check_table_name_length(table_name):
 
 
 def create_table_postgis(
-        file_name,
+        columns,
         table_name,
         schema,
-        engine,
         con,
-        if_exists='replace'):
+        if_exists='replace',
+        unlogged=False):
     """
-    Function that given a CSV file path, creates a table inside the Postgres database
+    Function that given the columns of a CARTO dataset, creates a table inside the Postgres database
     with the correct data structure
 
-    Depends on function check_table_length
-
-    This function reads the CSV file, creates a GeoDataFrame, formats the data to upload to PostgreSQL
-    and creates a table with the desired data types and column order.
+    This function creates a table with the same column names, data types and order as the
+    CARTO dataset, as required by PostgreSQL binary COPY format.
 
     Returns value to indicate if COPY process should happen (proceed_copy, bool)
     and psycopg2 cursor object (cursor)
     args:
-        file_name: path to csv file (str)
-        table_name: desired database table name (str)
+        columns: column names and SQL data types in table order (list of (str, str))
+        table_name: database table name, within PostgreSQL identifier length limit (str)
         schema: target database schema (str)
-        host: connection host (str)
-        database: target database (str)
-        user: connection user (str)
-        password: password for user (str)
+        con: psycopg2 connection object
         if_exists: defines how to behave if the table already exists {'fail', 'replace'}, default 'replace'
-                   - fail: Raise a ValueError
+                   - fail: Skip the dataset if the table already exists
                    - replace: Drop the table before inserting new values
+        unlogged: create the table as UNLOGGED, it must be set as logged once loaded (bool), default False
     """
 
     if if_exists not in COLLISION_STRATEGIES:
@@ -152,102 +290,174 @@ def create_table_postgis(
 
     cursor = con.cursor()
 
-    value = BaseGeometry()
+    table = sql.Identifier(schema, table_name)
 
-    table_name = check_table_name_length(table_name)
+    column_definitions = sql.SQL(', ').join(
+        sql.SQL('{} {}').format(sql.Identifier(column), sql.SQL(data_type))
+        for column, data_type in columns)
 
-    df = pd.read_csv(file_name, nrows=10)
+    try:
+        if if_exists == 'replace':
+            cursor.execute(sql.SQL('drop table if exists {};').format(table))
 
-    columns_ordered = [col if (col != 'the_geom')
-                       else 'geometry' for col in df.columns.values]
+        cursor.execute(sql.SQL('create {} table {} ({});').format(
+            sql.SQL('unlogged' if unlogged else ''), table, column_definitions))
 
-    gdf = gpd.GeoDataFrame(
-        df,
-        crs=4326,
-        geometry=decode_geometry(
-            df['the_geom']))
+    except Exception as e:
+        proceed_copy = False
+        con.rollback()
+        print(f"Some error ocurred creating table {e}")
 
-    gdf['geometry'].fillna(value, inplace=True)
+    return proceed_copy, cursor
 
-    gdf.drop('the_geom', axis=1, inplace=True)
 
-    gdf = gdf.reindex(columns=columns_ordered)
+def copy_to_postgis(con, copy_client, table_name, target_name, schema, where=None):
+    """
+    Function that streams a CARTO dataset, or part of it, into an existing Postgres table
+    using PostgreSQL COPY from command. The transaction is left open for the caller to commit.
 
-    try:
-        gdf.astype(object).to_postgis(
-            name=table_name,
-            schema=schema,
-            con=engine,
-            if_exists=if_exists)
+    Depends on function download_carto_dataset
+    args:
+        con: psycopg2 connection object
+        copy_client: CARTO COPY client (CopySQLClient)
+        table_name: source CARTO dataset, as quoted by carto_dataset_columns (str)
+        target_name: target database table name (str)
+        schema: target database schema (str)
+        where: SQL condition to copy only part of the dataset (str), default None
+    """
 
-        cursor.execute(f'truncate table "{schema}".{table_name};')
+    copy_sql = sql.SQL("""
+           COPY {} FROM stdin WITH (FORMAT binary)
+           """).format(sql.Identifier(schema, target_name)).as_string(con)
 
-        cursor.execute(
-            f'alter table "{schema}".{table_name} rename column geometry to the_geom;')
+    stream, download = download_carto_dataset(copy_client=copy_client, table_name=table_name, where=where)
 
-    except Exception as e:
-        proceed_copy = False
-        print(f"Some error ocurred creating table {e}")
+    with stream as f, con.cursor() as cursor:
+        cursor.copy_expert(sql=copy_sql, file=f, size=COPY_BUFFER_SIZE)
 
-    return proceed_copy, cursor
+    download.result()
+
+
+def create_index_postgis(con, table_name, schema):
+    """
+    Function that creates a GiST spatial index on the_geom column of a Postgres table
+
+    It is meant to be run once the data is copied, as building the index in bulk
+    is much cheaper than updating it for each row during the COPY
+    args:
+        con: psycopg2 connection object
+        table_name: target table name (str)
+        schema: target database schema (str)
+    """
+
+    cursor = con.cursor()
+
+    try:
+        cursor.execute(sql.SQL('create index on {} using gist (the_geom);').format(
+            sql.Identifier(schema, table_name)))
+        con.commit()
+        print(f"Spatial index created on {table_name}")
+    except Exception as e:
+        con.rollback()
+        print(f"Some error ocurred creating index {e}")
+    finally:
+        cursor.close()
 
 
 def dataset_to_postgis(
-        file_name,
+        copy_client,
         table_name,
         schema,
-        host,
-        database,
-        user,
-        password,
-        port=None,
-        sslmode=None,
-        sslrootcert=None,
-        sslcert=None,
-        sslkey=None,
-        if_exists='replace'):
+        pool,
+        if_exists='replace',
+        parts=COPY_PARTS):
     """
-    Function that uploads a dataset (CSV file) to a Postgres database.
-
-    Depends on function create_table_postgis
-    Once the table is created, it uses PostgreSQL COPY from command to upload the data
+    Function that uploads a CARTO dataset to a Postgres database.
+
+    Depends on functions check_table_name_length, carto_dataset_columns, create_table_postgis
+    and copy_to_postgis
+    Once the table is created, the dataset is split into cartodb_id ranges, if it has that column, which are uploaded
+    in parallel, each one with its own connection and PostgreSQL COPY from command.
+    With wal_level minimal the table is loaded as UNLOGGED and only set as logged afterwards.
+    It is spatially indexed, if it has the_geom, after all the data is copied
     args:
-        file_name: path to csv file (str)
+        copy_client: CARTO COPY client (CopySQLClient)
         table_name: desired database table name (str)
         schema: target database schema (str)
-        host: connection host (str)
-        database: target database (str)
-        user: connection user (str)
-        password: password for user (str)
+        pool: psycopg2 connection pool (ThreadedConnectionPool)
+        parts: maximum number of parallel COPY parts (int), default COPY_PARTS
     """
 
-    engine, con = connect_database(host=host, database=database,
-                                   user=user, password=password,
-                                   port=port,
-                                   sslmode=sslmode, sslrootcert=sslrootcert,
-                                   sslcert=sslcert, sslkey=sslkey)
+    target_name = check_table_name_length(table_name)
+
+    con = pool.getconn()
+
+    try:
+        source, columns = carto_dataset_columns(copy_client=copy_client, table_name=table_name)
+
+        # Datasets that were never cartodbfied have no cartodb_id to split them by
+        if 'cartodb_id' in [column for column, _ in columns]:
+            ranges = carto_dataset_ranges(copy_client=copy_client, table_name=source, parts=parts)
+        else:
+            ranges = ['true']
 
-    proceed_copy, cursor = create_table_postgis(
-        file_name=file_name, table_name=table_name, schema=schema, engine=engine, con=con, if_exists=if_exists)
+        with con.cursor() as cursor:
+            cursor.execute('show wal_level;')
+            unlogged = cursor.fetchone()[0] == 'minimal'
 
-    if proceed_copy:
+        proceed_copy, cursor = create_table_postgis(
+            columns=columns, table_name=target_name, schema=schema, con=con, if_exists=if_exists,
+            unlogged=unlogged)
 
-        copy_sql = f"""
-               COPY "{schema}".{table_name} FROM stdin WITH CSV HEADER
-               DELIMITER as ','
-               """
-        print(f"Copying dataset {table_name} to postgres")
+        # The COPY connections can only see the table once it is committed
+        con.commit()
+        cursor.close()
 
-        with open(file_name, 'r') as f:
+        if proceed_copy:
+
+            print(f"Copying dataset {table_name} to postgres in {len(ranges)} parts")
+
+            connections = [con] + [pool.getconn() for _ in ranges[1:]]
 
             try:
-                cursor.copy_expert(sql=copy_sql, file=f)
-                con.commit()
+                with ThreadPoolExecutor(max_workers=len(connections)) as executor:
+                    list(executor.map(copy_to_postgis, connections, repeat(copy_client),
+                                      repeat(source), repeat(target_name), repeat(schema), ranges))
+                for connection in connections:
+                    connection.commit()
+                if unlogged:
+                    with con.cursor() as cursor:
+                        cursor.execute(sql.SQL('alter table {} set logged;').format(
+                            sql.Identifier(schema, target_name)))
+                    con.commit()
                 print(f"Dataset {table_name} copied to postgres")
+                if 'the_geom' in [column for column, _ in columns]:
+                    create_index_postgis(con=con, table_name=target_name, schema=schema)
             except (Exception, psycopg2.DatabaseError) as error:
-                print(f"Some error ocurred copying dataset {error}")
-                con.rollback()
-            cursor.close()
+                print(f"Some error ocurred copying dataset {table_name}, dropping table: {error}")
+                for connection in connections:
+                    try:
+                        connection.rollback()
+                    except psycopg2.Error:
+                        # A terminated backend leaves its connection closed
+                        pass
+                # Parts may already be committed, do not leave a partial table behind
+                drop_con = next((connection for connection in connections if not connection.closed), None)
+                if drop_con is None:
+                    print(f"Table {table_name} could not be dropped, no database connection is left open")
+                else:
+                    try:
+                        with drop_con.cursor() as cursor:
+                            cursor.execute(sql.SQL('drop table if exists {};').format(
+                                sql.Identifier(schema, target_name)))
+                        drop_con.commit()
+                    except (Exception, psycopg2.DatabaseError) as drop_error:
+                        print(f"Some error ocurred dropping table {table_name} {drop_error}")
+            finally:
+                for connection in connections[1:]:
+                    pool.putconn(connection)
+    finally:
+        pool.putconn(con)
 
 
 def carto_to_postgis(
@@ -255,50 +465,31 @@ def carto_to_postgis(
         table_name,
         api_key,
         schema,
-        host,
-        database,
-        user,
-        password,
-        port=None,
-        sslmode=None,
-        sslrootcert=None,
-        sslcert=None,
-        sslkey=None,
-        if_exists='replace'):
+        pool,
+        if_exists='replace',
+        parts=COPY_PARTS):
     """
     Function that downloads a CARTO dataset and uploads it to a PostgreSQL database.
 
-    Depends on download_carto_dataset and dataset_to_postgis.
+    Depends on carto_copy_client and dataset_to_postgis.
     args:
         username: CARTO account username (str)
         api_key: CARTO API key with access to the dataset (str)
         table_name: desired database table name (str)
         schema: target database schema (str)
-        host: connection host (str)
-        database: target database (str)
-        user: connection user (str)
-        password: password for user (str)
+        pool: psycopg2 connection pool (ThreadedConnectionPool)
+        parts: maximum number of parallel COPY parts (int), default COPY_PARTS
     """
 
-    file_name = download_carto_dataset(username=username, api_key=api_key,
-                                       table_name=table_name)
+    copy_client = carto_copy_client(username=username, api_key=api_key)
 
     dataset_to_postgis(
-        file_name=file_name,
+        copy_client=copy_client,
         table_name=table_name,
         schema=schema,
-        host=host,
-        database=database,
-        user=user,
-        port=port,
-        password=password,
-        sslmode=sslmode,
-        sslrootcert=sslrootcert,
-        sslcert=sslcert,
-        sslkey=sslkey,
-        if_exists=if_exists)
-
-    os.remove(file_name)
+        pool=pool,
+        if_exists=if_exists,
+        parts=parts)
 
 
 with open("config.json") as config:
@@ -309,6 +500,7 @@ api_key = config.get('api_key')
 schema = config.get('schema')
 if_exists = config.get('if_exists')
 table_list = config.get('table_list')
+max_connections = config.get('max_connections') or MAX_CONNECTIONS
 
 param_dict = {
     "host": config.get('host'),
@@ -322,7 +514,21 @@ param_dict = {
     "sslmode": config.get('sslmode')
 }
 
-for table_name in tqdm(table_list):
+# Tables are transferred in parallel first, the remaining budget splits each one into COPY parts
+table_workers = max(1, min(TABLE_WORKERS, len(table_list), max_connections))
+copy_parts = max(1, min(COPY_PARTS, max_connections // table_workers))
+
+pool = connect_database(**param_dict, maintenance_work_mem=config.get('maintenance_work_mem'),
+                        maxconn=table_workers * copy_parts)
+
+try:
+    with ThreadPoolExecutor(max_workers=table_workers) as executor:
+
+        futures = [executor.submit(carto_to_postgis, username=username, table_name=table_name, api_key=api_key,
+                                   schema=schema, pool=pool, if_exists=if_exists, parts=copy_parts)
+                   for table_name in table_list]
 
-    carto_to_postgis(username=username, table_name=table_name, api_key=api_key,
-                     schema=schema, **param_dict, if_exists=if_exists)
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            future.result()
+finally:
+    pool.closeall()